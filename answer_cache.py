@@ -0,0 +1,138 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import chainlit as cl
+from literalai.helper import utc_now
+
+ANSWER_CACHE_DIR = os.getenv("ANSWER_CACHE_DIR", "./.answer-cache")
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "100"))
+NO_CACHE_PREFIX = "/nocache"
+REPLAY_CHUNK_SIZE = 40
+
+whitespace_pattern = re.compile(r"\s+")
+
+
+class AnswerRecorder:
+    """Record the steps, messages and artifacts of an assistant answer so it can be replayed."""
+
+    def __init__(self: "AnswerRecorder") -> None:
+        self.items = []
+        self.failed = False
+
+    def add_step(self: "AnswerRecorder", name: str, language: str, output: str) -> None:
+        self.items.append({"type": "step", "name": name, "language": language, "output": output})
+
+    def add_message(self: "AnswerRecorder", content: str, elements: list | None = None) -> None:
+        """Record a message. Elements are dicts with a kind ("file" or "image"), name and content bytes."""
+        elements = [
+            {**element, "content": base64.b64encode(element["content"]).decode()} for element in elements or []
+        ]
+        self.items.append({"type": "message", "content": content, "elements": elements})
+
+
+def answer_text(items: list) -> str:
+    """Return the text of the messages in a recorded answer."""
+    return "\n\n".join(item["content"] for item in items if item["type"] == "message" and item["content"])
+
+
+class AnswerCache:
+    """Cache recorded answers by normalized message text, language and database version.
+
+    Entries are persisted to ANSWER_CACHE_DIR and loaded at startup, so answers recorded before a
+    restart are replayed without a new assistant run.
+    """
+
+    def __init__(self: "AnswerCache", directory: str = ANSWER_CACHE_DIR) -> None:
+        self.directory = Path(directory)
+        self.entries: OrderedDict = OrderedDict()
+        self.load()
+
+    @staticmethod
+    def parse_message(content: str) -> tuple:
+        """Return the message content without the opt-out prefix, and whether the cache may be used."""
+        stripped = content.lstrip()
+        if stripped.lower().startswith(NO_CACHE_PREFIX):
+            return stripped[len(NO_CACHE_PREFIX) :].lstrip(), False
+        return content, True
+
+    @staticmethod
+    def key(content: str, language: str, fingerprint: str) -> str:
+        normalized = whitespace_pattern.sub(" ", content).strip().rstrip(".!?").casefold()
+        return hashlib.sha256(f"{normalized}\0{language}\0{fingerprint}".encode()).hexdigest()
+
+    def load(self: "AnswerCache") -> None:
+        """Pre-warm the cache with unexpired entries persisted by earlier runs."""
+        if not self.directory.is_dir():
+            return
+        entries = []
+        for path in self.directory.glob("*.json"):
+            try:
+                entries.append(json.loads(path.read_text(encoding="utf-8")))
+            except (OSError, ValueError):
+                path.unlink(missing_ok=True)
+        for entry in sorted(entries, key=lambda entry: entry["created"]):
+            self.entries[entry["key"]] = entry
+        self.evict()
+
+    def evict(self: "AnswerCache") -> None:
+        """Remove expired entries and the least recently used entries above the size limit."""
+        now = time.time()
+        expired = [key for key, entry in self.entries.items() if now - entry["created"] > ANSWER_CACHE_TTL_SECONDS]
+        overflow = list(self.entries)[: max(len(self.entries) - ANSWER_CACHE_MAX_ENTRIES, 0)]
+        for key in {*expired, *overflow}:
+            self.entries.pop(key, None)
+            (self.directory / f"{key}.json").unlink(missing_ok=True)
+
+    def get(self: "AnswerCache", key: str) -> list | None:
+        self.evict()
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry["items"]
+
+    def put(self: "AnswerCache", key: str, items: list) -> None:
+        entry = {"key": key, "created": time.time(), "items": items}
+        self.entries[key] = entry
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            (self.directory / f"{key}.json").write_text(json.dumps(entry), encoding="utf-8")
+        except OSError as e:
+            print(f"Unable to persist cached answer: {e}")
+        self.evict()
+
+
+async def replay_answer(items: list, assistant_name: str) -> None:
+    """Replay a recorded answer through the same step and message streaming path as a live run."""
+    for item in items:
+        if item["type"] == "step":
+            current_step = cl.Step(name=item["name"], type="tool")
+            current_step.language = item["language"]
+            await current_step.stream_token(item["output"])
+            current_step.start = utc_now()
+            await current_step.send()
+            continue
+
+        elements = []
+        for element in item["elements"]:
+            content = base64.b64decode(element["content"])
+            if element["kind"] == "image":
+                elements.append(cl.Image(name=element["name"], content=content, display="inline", size="large"))
+            else:
+                elements.append(cl.File(name=element["name"], content=content, display="inline"))
+
+        current_message = await cl.Message(author=assistant_name, content="", elements=elements).send()
+        content = item["content"]
+        for index in range(0, len(content), REPLAY_CHUNK_SIZE):
+            await current_message.stream_token(content[index : index + REPLAY_CHUNK_SIZE])
+        await current_message.update()
+
+
+answer_cache = AnswerCache()
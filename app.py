@@ -12,8 +12,12 @@ from dotenv import load_dotenv
 import httpx
 import openai
 
+from answer_cache import AnswerRecorder, answer_cache, answer_text, replay_answer
 from event_handler import EventHandler
-from sales_data import SalesData
+from run_manager import RunManager
+from sales_data import APPROXIMATE_QUERIES
+from snapshot_manager import snapshot_manager
+from sales_metrics import DIMENSIONS, FILTERS, METRICS
 
 load_dotenv()
 
@@ -25,11 +29,17 @@ AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 AZURE_OPENAI_ASSISTANT_ID = os.getenv("AZURE_OPENAI_ASSISTANT_ID")
 
 assistant = None
-sales_data = SalesData()
+database_schema_string = None
 cl.instrument_openai()
 
 function_map: Dict[str, Callable[[Any], str]] = {
-    "ask_database": lambda args: sales_data.ask_database(query=args.get("query")),
+    "ask_database": lambda args: snapshot_manager.sales_data.ask_database(
+        query=args.get("query"), exact=args.get("exact", False)
+    ),
+    "query_sales_metrics": lambda args: snapshot_manager.sales_data.query_sales_metrics(arguments=args),
+    "export_query_result": lambda args: snapshot_manager.sales_data.export_query_result(
+        handle=args.get("handle"), file_format=args.get("file_format", "csv")
+    ),
 }
 
 
@@ -64,14 +74,21 @@ async def auth_callback(username: str, password: str):
     return None
 
 
-async def initialize(sales_data: SalesData, api_key: str):
-    await sales_data.connect()
-    database_schema_string = await sales_data.get_database_info()
+async def get_database_schema_string() -> str:
+    await snapshot_manager.start()
+    return await snapshot_manager.sales_data.get_database_info()
+
+
+async def initialize(api_key: str):
+    global database_schema_string
+    database_schema_string = await get_database_schema_string()
 
     instructions = (
         "You are a Contoso sales analysis assistant. Assist users with their sales data inquiries in a polite, professional manner, providing brief explanations.",
         "Access sales data using the `ask_database` function, which returns results in JSON format.",
+        "Prefer the `query_sales_metrics` function for totals, averages and counts grouped or filtered by year, month, region, main category or product type. Use `ask_database` only for questions it cannot express.",
         "When querying with the ask_database function, default to aggregated data unless a detailed breakdown is requested.",
+        "Large query results are returned as summary statistics and a sample with a handle. Answer from the summary or aggregate the data, and use the `export_query_result` function when the user wants the full result.",
         f"The sales database follows this SQLite schema: {database_schema_string}.",
         "You can also use the `file_search` tool to retrieve relevant product information.",
         "If a user requests 'help,' provide example questions related to sales data inquiries that you can assist with.",
@@ -115,8 +132,84 @@ async def initialize(sales_data: SalesData, api_key: str):
                 },
             },
         },
+        {
+            "type": "function",
+            "function": {
+                "name": "query_sales_metrics",
+                "description": "Use this function to answer aggregate questions about contoso sales data, such as totals, averages and counts grouped or filtered by year, month, region, main category or product type.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "metrics": {
+                            "type": "array",
+                            "items": {"type": "string", "enum": list(METRICS)},
+                            "description": "The metrics to aggregate. average_revenue is the average revenue per sale, sales_count is the number of sales records.",
+                        },
+                        "group_by": {
+                            "type": "array",
+                            "items": {"type": "string", "enum": DIMENSIONS},
+                            "description": "The dimensions to group the metrics by. Omit for grand totals.",
+                        },
+                        "filters": {
+                            "type": "object",
+                            "properties": {
+                                column: {
+                                    "type": "array",
+                                    "items": {"type": "integer" if cast is int else "string"},
+                                }
+                                for column, cast in FILTERS.items()
+                            },
+                            "description": "Restrict the data to the listed values of each column. Use values from the database schema.",
+                            "additionalProperties": False,
+                        },
+                        "order_by": {
+                            "type": "string",
+                            "description": "A requested metric or group_by dimension to sort by. Defaults to the first group_by dimension.",
+                        },
+                        "order": {"type": "string", "enum": ["asc", "desc"]},
+                        "limit": {
+                            "type": "integer",
+                            "description": "The maximum number of rows to return. Defaults to 100, at most 1000.",
+                        },
+                    },
+                    "required": ["metrics"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "export_query_result",
+                "description": "Use this function to give the user the full result of an earlier query that was returned as a sample with a handle.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "handle": {
+                            "type": "string",
+                            "description": "The handle of the query result.",
+                        },
+                        "file_format": {"type": "string", "enum": ["csv", "json"]},
+                    },
+                    "required": ["handle"],
+                    "additionalProperties": False,
+                },
+            },
+        },
     ]
 
+    if APPROXIMATE_QUERIES:
+        instructions += (
+            "Aggregate results may be estimated from a sample; the result metadata then gives the relative error. Mention that figures are approximate.",
+            "Set `exact` to true when the user asks for exact, precise or final figures, or to confirm a close comparison.",
+        )
+        for tool in tools_list:
+            if tool.get("function", {}).get("name") in ("ask_database", "query_sales_metrics"):
+                tool["function"]["parameters"]["properties"]["exact"] = {
+                    "type": "boolean",
+                    "description": "Set to true to compute exact figures instead of estimates from a sample.",
+                }
+
     try:
         sync_openai_client = AzureOpenAI(
             azure_endpoint=AZURE_OPENAI_ENDPOINT,
@@ -177,14 +270,18 @@ async def start_chat():
         metadata = cl.user_session.get("user").metadata
         api_key = metadata.get("api_key")
 
-        if assistant is None:
-            assistant = await initialize(sales_data=sales_data, api_key=api_key)
+        # Re-initialize the assistant when a new database snapshot changes the schema it was given
+        if assistant is None or await get_database_schema_string() != database_schema_string:
+            assistant = await initialize(api_key=api_key)
 
         async_openai_client = get_openai_client()
         thread_id = cl.user_session.get("thread_id")
         if not thread_id:
             thread = await async_openai_client.beta.threads.create()
-            cl.user_session.set("thread_id", thread.id)
+            thread_id = thread.id
+            cl.user_session.set("thread_id", thread_id)
+
+        cl.user_session.set("run_manager", RunManager(async_openai_client, thread_id))
 
     except Exception as e:
         cl.user_session.set("thread_id", None)
@@ -196,23 +293,39 @@ async def start_chat():
 async def on_chat_resume(thread: ThreadDict):
     await start_chat()
 
+    # Re-attach to a run that was still in progress when the chat was left
+    run_manager = cl.user_session.get("run_manager")
+    if not run_manager:
+        return
+
+    try:
+        await run_manager.resume(
+            EventHandler(
+                function_map=function_map,
+                assistant_name=assistant.name,
+                async_openai_client=run_manager.async_openai_client,
+                run_manager=run_manager,
+            ),
+            assistant.name,
+        )
+
+    # triggered when the user stops a chat
+    except asyncio.exceptions.CancelledError:
+        pass
+
+    except Exception as e:
+        await cl.Message(content=f"Unable to resume the run in progress: {e}").send()
+
 
 @cl.on_stop
 async def stop_chat():
-    current_run = cl.user_session.get("current_run")
-    if current_run:
+    run_manager = cl.user_session.get("run_manager")
+    if run_manager:
         try:
-            thread_id = getattr(current_run, "thread_id", None)
-            run_id = getattr(current_run, "run_id", None)
-            status = getattr(current_run, "status", None)
-            async_openai_client = get_openai_client()
-            if thread_id and run_id and async_openai_client and status != "completed":
-                await async_openai_client.beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id)
+            if run_id := await run_manager.cancel():
                 await cl.Message(content=f"Run cancelled. {run_id}").send()
-        except Exception:
-            pass
-        finally:
-            cl.user_session.set("current_run", None)
+        except openai.OpenAIError as e:
+            await cl.Message(content=f"Unable to cancel the run: {e}").send()
 
 
 async def get_attachments(message: cl.Message, async_openai_client: AsyncAzureOpenAI) -> Dict:
@@ -236,36 +349,66 @@ async def get_attachments(message: cl.Message, async_openai_client: AsyncAzureOp
 @cl.on_message
 async def main(message: cl.Message) -> None:
     thread_id = cl.user_session.get("thread_id")
+    run_manager = cl.user_session.get("run_manager")
     async_openai_client = get_openai_client()
 
-    if not thread_id or not async_openai_client:
+    if not thread_id or not run_manager or not async_openai_client:
         await cl.Message(content="An error occurred. Please try again later.").send()
         return
 
+    content, use_cache = answer_cache.parse_message(message.content)
+
+    # Only the opening question of a thread is cached, as later answers depend on the conversation.
+    # The OpenAI thread is only checked for prior messages in a new or resumed session, before this session sends one.
+    cache_key = None
+    if use_cache and not message.elements and not cl.user_session.get("thread_has_messages"):
+        prior_messages = await async_openai_client.beta.threads.messages.list(thread_id=thread_id, limit=1)
+        if not prior_messages.data:
+            language = (cl.user_session.get("languages") or "").split(",")[0]
+            cache_key = answer_cache.key(content, language, snapshot_manager.version)
+    cl.user_session.set("thread_has_messages", True)
+
+    if cache_key and (items := answer_cache.get(cache_key)):
+        await replay_answer(items, assistant.name)
+        # Keep the thread in step with the replayed answer for follow up questions
+        await async_openai_client.beta.threads.messages.create(thread_id=thread_id, role="user", content=content)
+        await async_openai_client.beta.threads.messages.create(
+            thread_id=thread_id, role="assistant", content=answer_text(items)
+        )
+        return
+
     message_files = await get_attachments(message, async_openai_client)
+    recorder = AnswerRecorder() if cache_key else None
 
     try:
         # Add a Message to the Thread
         await async_openai_client.beta.threads.messages.create(
             thread_id=thread_id,
             role="user",
-            content=message.content,
+            content=content,
             attachments=message_files,
         )
 
         # Create and Stream a Run
-        async with async_openai_client.beta.threads.runs.stream(
-            thread_id=thread_id,
-            assistant_id=assistant.id,
-            event_handler=EventHandler(
-                function_map=function_map,
-                assistant_name=assistant.name,
-                async_openai_client=async_openai_client,
-            ),
-            temperature=0.3,
+        async with run_manager.stream(
+            async_openai_client.beta.threads.runs.stream(
+                thread_id=thread_id,
+                assistant_id=assistant.id,
+                event_handler=EventHandler(
+                    function_map=function_map,
+                    assistant_name=assistant.name,
+                    async_openai_client=async_openai_client,
+                    run_manager=run_manager,
+                    recorder=recorder,
+                ),
+                temperature=0.3,
+            )
         ) as stream:
             await stream.until_done()
 
+        if recorder and not recorder.failed and answer_text(recorder.items):
+            answer_cache.put(cache_key, recorder.items)
+
     # triggered when the user stops a chat
     except asyncio.exceptions.CancelledError:
         pass
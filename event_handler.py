@@ -1,11 +1,16 @@
 import asyncio
+import itertools
 import json
 import re
 from typing_extensions import override
-from openai import AsyncAssistantEventHandler
+from openai import AsyncAssistantEventHandler, AsyncAzureOpenAI
+from openai.types.beta import AssistantStreamEvent
+from openai.types.beta.threads import Run
 from openai.types.beta.threads.runs.function_tool_call import FunctionToolCall
 import chainlit as cl
 from literalai.helper import utc_now
+from answer_cache import AnswerRecorder
+from run_manager import RunManager
 from sales_data import QueryResults
 
 markdown_link_pattern = re.compile(r"\[(.*?)\]\s*\(\s*.*?\s*\)")
@@ -13,7 +18,14 @@ citation_pattern = re.compile(r"【.*?】")
 
 
 class EventHandler(AsyncAssistantEventHandler):
-    def __init__(self, function_map: dict, assistant_name: str, async_openai_client) -> None:
+    def __init__(
+        self,
+        function_map: dict,
+        assistant_name: str,
+        async_openai_client: AsyncAzureOpenAI,
+        run_manager: RunManager,
+        recorder: AnswerRecorder = None,
+    ) -> None:
         super().__init__()
         self.current_message: cl.Message = None
         self.current_step: cl.Step = None
@@ -22,6 +34,8 @@ class EventHandler(AsyncAssistantEventHandler):
         self.async_openai_client = async_openai_client
         self.function_map = function_map
         self.citations_index = 1
+        self.run_manager = run_manager
+        self.recorder = recorder
 
     async def get_file_annotation(self, file_path, annotation) -> tuple:
         file_name = annotation.text.split("/")[-1]
@@ -29,8 +43,15 @@ class EventHandler(AsyncAssistantEventHandler):
         return content.content, file_name
 
     @override
-    async def on_run_step_created(self, run_step):
-        cl.user_session.set("current_run", run_step)
+    async def on_event(self, event: AssistantStreamEvent) -> None:
+        if event.event == "thread.run.created":
+            self.run_manager.attach_run(event.data.id)
+        elif event.event in ("thread.run.completed", "thread.run.cancelled", "thread.run.expired"):
+            self.run_manager.detach_run(event.data.id)
+        elif event.event in ("thread.run.failed", "thread.run.incomplete"):
+            self.run_manager.detach_run(event.data.id)
+            if self.recorder:
+                self.recorder.failed = True
 
     @override
     async def on_text_created(self: "EventHandler", text) -> None:
@@ -50,8 +71,18 @@ class EventHandler(AsyncAssistantEventHandler):
         elif delta.value:
             await self.current_message.stream_token(delta.value)
 
+    def record_text(self: "EventHandler", value: str) -> None:
+        """Record the text as it is displayed, with links removed and citations numbered."""
+        citations_index = itertools.count(1)
+        value = markdown_link_pattern.sub(r"\1", value)
+        value = citation_pattern.sub(lambda _: f"[{next(citations_index)}]", value)
+        self.recorder.add_message(value)
+
     @override
     async def on_text_done(self: "EventHandler", text: str) -> None:
+        if self.recorder:
+            self.record_text(text.value)
+
         citations = []
         index = 0
         for annotation in text.annotations:
@@ -70,9 +101,13 @@ class EventHandler(AsyncAssistantEventHandler):
                     ),
                 ]
                 await cl.Message(content="", elements=elements).send()
+                if self.recorder:
+                    self.recorder.add_message("", [{"kind": "file", "name": file_name, "content": format_text}])
 
         if citations:
             await cl.Message(content="\n".join(citations)).send()
+            if self.recorder:
+                self.recorder.add_message("\n".join(citations))
 
         await self.current_message.update()
 
@@ -110,6 +145,8 @@ class EventHandler(AsyncAssistantEventHandler):
             self.current_message.elements = []
         self.current_message.elements.append(image_element)
         await self.current_message.update()
+        if self.recorder:
+            self.recorder.add_message("", [{"kind": "image", "name": image_id, "content": response.content}])
 
     async def update_chainlit_function_ui(self, language: str, tool_call, result: QueryResults) -> None:
         # Update the UI with the step function output
@@ -120,8 +157,62 @@ class EventHandler(AsyncAssistantEventHandler):
         await current_step.stream_token(result.display_format)
         current_step.start = utc_now()
         await current_step.send()
+        if result.file_content:
+            elements = [cl.File(name=result.file_name, content=result.file_content, display="inline")]
+            await cl.Message(content="", elements=elements).send()
+        if self.recorder:
+            self.recorder.add_step(current_step.name, language, current_step.output)
+            if result.file_content:
+                file_element = {"kind": "file", "name": result.file_name, "content": result.file_content}
+                self.recorder.add_message("", [file_element])
         self.current_message = await cl.Message(author=self.assistant_name, content="").send()
 
+    async def call_function(self, tool_call: FunctionToolCall) -> QueryResults:
+        function = self.function_map.get(tool_call.function.name)
+
+        try:
+            arguments = json.loads(tool_call.function.arguments)
+            return await function(arguments)
+        except json.JSONDecodeError as e:
+            return QueryResults(
+                display_format=tool_call.function.arguments,
+                json_format=str(e),
+            )
+
+    async def submit_tool_outputs(self, run: Run) -> None:
+        """Call the functions a run requires and stream the rest of the run with the tool outputs."""
+        tool_calls = run.required_action.submit_tool_outputs.tool_calls
+        function_tool_calls = [call for call in tool_calls if call.type == "function"]
+        tool_outputs = []
+
+        # Function calls run as tasks tracked by the run manager, so stopping the chat cancels them
+        results = await asyncio.gather(
+            *[self.run_manager.track(self.call_function(submit_tool_call)) for submit_tool_call in function_tool_calls]
+        )
+
+        for submit_tool_call, result in zip(function_tool_calls, results, strict=True):
+            tool_outputs.append({"tool_call_id": submit_tool_call.id, "output": result.json_format})
+            await self.update_chainlit_function_ui("sql", submit_tool_call, result)
+
+        if tool_outputs:
+            async with self.run_manager.stream(
+                self.async_openai_client.beta.threads.runs.submit_tool_outputs_stream(
+                    thread_id=run.thread_id,
+                    run_id=run.id,
+                    tool_outputs=tool_outputs,
+                    event_handler=EventHandler(
+                        self.function_map,
+                        self.assistant_name,
+                        self.async_openai_client,
+                        self.run_manager,
+                        self.recorder,
+                    ),
+                )
+            ) as stream:
+                await stream.until_done()
+
+            await self.current_message.update()
+
     @override
     async def on_tool_call_done(self, tool_call: FunctionToolCall) -> None:
         """This method is called when a tool call is done."""
@@ -129,55 +220,24 @@ class EventHandler(AsyncAssistantEventHandler):
 
         try:
             if tool_call.type == "function" and self.current_run.status == "requires_action":
-                tool_calls = self.current_run.required_action.submit_tool_outputs.tool_calls
-                function_tool_calls = [call for call in tool_calls if call.type == "function"]
-                tool_outputs = []
-
-                for submit_tool_call in function_tool_calls:
-                    function = self.function_map.get(submit_tool_call.function.name)
-
-                    try:
-                        arguments = json.loads(submit_tool_call.function.arguments)
-                        result: QueryResults = await function(arguments)
-                    except json.JSONDecodeError as e:
-                        result = QueryResults(
-                            display_format=submit_tool_call.function.arguments,
-                            json_format=str(e),
-                        )
-
-                    tool_outputs.append({"tool_call_id": submit_tool_call.id, "output": result.json_format})
-                    await self.update_chainlit_function_ui("sql", submit_tool_call, result)
-
-                if tool_outputs:
-                    async with self.async_openai_client.beta.threads.runs.submit_tool_outputs_stream(
-                        thread_id=self.current_run.thread_id,
-                        run_id=self.current_run.id,
-                        tool_outputs=tool_outputs,
-                        event_handler=EventHandler(
-                            self.function_map,
-                            self.assistant_name,
-                            self.async_openai_client,
-                        ),
-                    ) as stream:
-                        await stream.until_done()
-
-                    await self.current_message.update()
+                await self.submit_tool_outputs(self.current_run)
 
             elif tool_call.type == "code_interpreter":
                 self.current_step.end = utc_now()
                 await self.current_step.update()
+                if self.recorder:
+                    self.recorder.add_step(self.current_step.name, "python", self.current_step.output)
             elif tool_call.type == "file_search":
                 pass
 
-        # triggered when the user stops a chat
+        # triggered when the user stops a chat, the run manager cancels the run
         except asyncio.exceptions.CancelledError:
-            pass
-            # if stream and stream.current_run and stream.current_run.status != "completed":
-            #     await self.async_openai_client.beta.threads.runs.cancel(
-            #         run_id=stream.current_run.id, thread_id=stream.current_run.thread_id
-            #     )
-            #     await cl.Message(content=f"Run cancelled. {stream.current_run.id}").send()
+            if self.recorder:
+                self.recorder.failed = True
+            raise
 
         except Exception as e:
+            if self.recorder:
+                self.recorder.failed = True
             await cl.Message(content=f"An error occurred: {e}").send()
             await cl.Message(content="Please try again in a moment.").send()
@@ -1,8 +1,38 @@
-from fastapi import FastAPI
+import os
+import secrets
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, Header, HTTPException
 from chainlit.utils import mount_chainlit
 
+load_dotenv()
+
+from snapshot_manager import snapshot_manager
+
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
 
 app = FastAPI()
 
 
+def verify_admin_key(admin_key: str) -> None:
+    if not ADMIN_API_KEY or not secrets.compare_digest(admin_key, ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.get("/admin/snapshot")
+async def get_snapshot(x_admin_key: str = Header(default="")) -> dict:
+    verify_admin_key(x_admin_key)
+    return snapshot_manager.status()
+
+
+@app.post("/admin/snapshot/refresh")
+async def refresh_snapshot(force: bool = False, x_admin_key: str = Header(default="")) -> dict:
+    verify_admin_key(x_admin_key)
+    try:
+        changed = await snapshot_manager.refresh(force=force)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database snapshot refresh failed: {e}") from e
+    return {"changed": changed, **snapshot_manager.status()}
+
+
 mount_chainlit(app=app, target="app.py", path="/sales")
@@ -0,0 +1,108 @@
+import asyncio
+import contextlib
+from collections.abc import AsyncIterator, Coroutine
+from typing import TYPE_CHECKING
+
+import chainlit as cl
+from openai import AsyncAssistantEventHandler, AsyncAzureOpenAI
+from openai.lib.streaming import AsyncAssistantStreamManager
+from openai.types.beta.threads import Run
+
+if TYPE_CHECKING:
+    from event_handler import EventHandler
+
+ACTIVE_RUN_STATUSES = ("queued", "in_progress", "requires_action")
+
+
+class RunManager:
+    """Track the assistant run of a chat session, its nested tool output streams and function tasks.
+
+    Everything started for the run is cancelled together when the user stops the chat, and a run
+    still in progress when a chat is resumed is re-attached rather than left running.
+    """
+
+    def __init__(self: "RunManager", async_openai_client: AsyncAzureOpenAI, thread_id: str) -> None:
+        self.async_openai_client = async_openai_client
+        self.thread_id = thread_id
+        self.run_id = None
+        self.streams = set()
+        self.tasks = set()
+
+    def attach_run(self: "RunManager", run_id: str) -> None:
+        self.run_id = run_id
+
+    def detach_run(self: "RunManager", run_id: str) -> None:
+        if self.run_id == run_id:
+            self.run_id = None
+
+    def track(self: "RunManager", coro: Coroutine) -> asyncio.Task:
+        """Run the coroutine as a task that is cancelled with the run."""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    @contextlib.asynccontextmanager
+    async def stream(
+        self: "RunManager", stream_manager: AsyncAssistantStreamManager
+    ) -> AsyncIterator[AsyncAssistantEventHandler]:
+        """Enter an assistant stream manager and track the stream until it is done."""
+        async with stream_manager as stream:
+            self.streams.add(stream)
+            try:
+                yield stream
+            finally:
+                self.streams.discard(stream)
+
+    async def cancel(self: "RunManager") -> str | None:
+        """Cancel the tracked tasks and streams and the run itself. Return the id of the cancelled run."""
+        for task in list(self.tasks):
+            task.cancel()
+        for stream in list(self.streams):
+            await stream.close()
+
+        run_id, self.run_id = self.run_id, None
+        if not run_id:
+            return None
+
+        run = await self.async_openai_client.beta.threads.runs.retrieve(run_id=run_id, thread_id=self.thread_id)
+        if run.status not in ACTIVE_RUN_STATUSES:
+            return None
+        await self.async_openai_client.beta.threads.runs.cancel(run_id=run_id, thread_id=self.thread_id)
+        return run_id
+
+    async def active_run(self: "RunManager") -> Run | None:
+        """Return the latest run of the thread if it is still in progress."""
+        runs = await self.async_openai_client.beta.threads.runs.list(thread_id=self.thread_id, limit=1, order="desc")
+        if runs.data and runs.data[0].status in ACTIVE_RUN_STATUSES:
+            return runs.data[0]
+        return None
+
+    async def resume(self: "RunManager", event_handler: "EventHandler", assistant_name: str) -> None:
+        """Re-attach to a run still in progress, completing any pending tool calls with the event handler."""
+        run = await self.active_run()
+        if run is None:
+            return
+
+        self.attach_run(run.id)
+        await cl.Message(content=f"Resuming run in progress. {run.id}").send()
+        await self.track(self.__complete_run(run, event_handler, assistant_name))
+
+    async def __complete_run(self: "RunManager", run: Run, event_handler: "EventHandler", assistant_name: str) -> None:
+        run = await self.async_openai_client.beta.threads.runs.poll(run_id=run.id, thread_id=self.thread_id)
+        if run.status == "requires_action":
+            await event_handler.submit_tool_outputs(run)
+            return
+
+        self.detach_run(run.id)
+        if run.status != "completed":
+            await cl.Message(content=f"The run ended with status {run.status}. Please try again.").send()
+            return
+
+        messages = await self.async_openai_client.beta.threads.messages.list(
+            thread_id=self.thread_id, run_id=run.id, order="asc"
+        )
+        for message in messages.data:
+            for content in message.content:
+                if content.type == "text":
+                    await cl.Message(author=assistant_name, content=content.text.value).send()
@@ -1,24 +1,80 @@
+import asyncio
+import contextlib
+import os
+import sqlite3
+from collections import OrderedDict
+from collections.abc import Iterator
+from pathlib import Path
+
 import aiosqlite
 import pandas as pd
 import json
 from pydantic import BaseModel
 
+from sales_metrics import build_metrics_statement
+from sales_sampling import build_sample_statement, error_bounds, rewrite_for_sample
+from tool_output import encode_results, result_store
+
 DATA_BASE = "./database/contoso-sales.db"
+STATEMENT_CACHE_SIZE = int(os.getenv("SALES_DATA_STATEMENT_CACHE_SIZE", "256"))
+METRICS_CACHE_SIZE = int(os.getenv("SALES_DATA_METRICS_CACHE_SIZE", "256"))
+DISPLAY_MAX_ROWS = 200
+WARM_READ_CHUNK_SIZE = 1024 * 1024
+INTERRUPT_POLL_SECONDS = 0.05
+
+# Approximate mode answers aggregate queries from stratified samples once the data is large enough
+APPROXIMATE_QUERIES = os.getenv("SALES_DATA_APPROXIMATE", "false").lower() == "true"
+APPROXIMATE_MIN_ROWS = int(os.getenv("SALES_DATA_APPROXIMATE_MIN_ROWS", "1000000"))
+APPROXIMATE_MAX_ERROR = float(os.getenv("SALES_DATA_APPROXIMATE_MAX_ERROR", "0.05"))
+SAMPLE_RATES = sorted(float(rate) for rate in os.getenv("SALES_DATA_SAMPLE_RATES", "0.01,0.1").split(","))
+SAMPLE_MIN_STRATUM_ROWS = 30
+
+# Once a snapshot is warmed, its connection only prepares statements that read
+READ_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+READ_PRAGMAS = {"table_info", "table_xinfo", "index_list", "index_info"}
+
+# Common rollups computed when a database snapshot is warmed, before it receives queries.
+WARM_ROLLUPS = [
+    {"metrics": ["revenue", "number_of_orders"], "group_by": ["year"]},
+    {"metrics": ["revenue", "number_of_orders"], "group_by": ["year", "region"]},
+    {"metrics": ["revenue", "number_of_orders"], "group_by": ["year", "main_category"]},
+    {"metrics": ["revenue"], "group_by": ["month_date"], "limit": 1000},
+]
+
+
+def authorize_read(action: int, arg1: str | None, _arg2: str | None, _database: str | None, _trigger: str | None) -> int:
+    """SQLite authorizer that denies everything except reading, including writes to the temporary databases."""
+    if action in READ_ACTIONS or (action == sqlite3.SQLITE_PRAGMA and arg1.lower() in READ_PRAGMAS):
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
 
 
 class QueryResults(BaseModel):
     display_format: str = ""
     json_format: str = ""
+    file_name: str = ""
+    file_content: bytes = b""
+    handle: str = ""
 
 
 class SalesData:
-    def __init__(self: "SalesData") -> None:
+    def __init__(self: "SalesData", database: str = DATA_BASE, version: str = "") -> None:
         self.conn = None
+        self.database = database
+        self.version = version
+        self.database_info = None
+        self.metrics_cache: OrderedDict = OrderedDict()
+        self.sample_rates = []
+        self.query_lock = asyncio.Lock()
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
 
     async def connect(self):
-        db_uri = f"file:{DATA_BASE}?mode=ro"
+        db_uri = f"file:{self.database}?mode=ro"
         try:
-            self.conn = await aiosqlite.connect(db_uri, uri=True)
+            # The metrics statements are parameterized, so SQLite's per-connection statement cache reuses their plans.
+            self.conn = await aiosqlite.connect(db_uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE)
             print("Database connection opened.")
         except aiosqlite.Error as e:
             print(f"An error occurred: {e}")
@@ -29,6 +85,46 @@ class SalesData:
             await self.conn.close()
             print("Database connection closed.")
 
+    async def drain_and_close(self: "SalesData") -> None:
+        """Wait for in-flight queries to finish, then close the connection."""
+        # Re-check after waking, as the event may have been cleared again by a query started in between
+        while True:
+            await self.idle.wait()
+            await asyncio.sleep(0)
+            if not self.in_flight:
+                break
+        await self.close()
+
+    def __read_database_file(self: "SalesData") -> None:
+        """Read the database file sequentially so its pages are in the OS page cache."""
+        with Path(self.database).open("rb") as file:
+            while file.read(WARM_READ_CHUNK_SIZE):
+                pass
+
+    async def build_samples(self: "SalesData") -> None:
+        """Build the stratified sample tables, one per sample rate, in a temporary database attached as samples."""
+        async with self.conn.execute("SELECT COUNT(*) FROM sales_data;") as cursor:
+            (row_count,) = await cursor.fetchone()
+        if row_count < APPROXIMATE_MIN_ROWS:
+            return
+
+        await self.conn.execute("ATTACH DATABASE '' AS samples;")
+        for rate in SAMPLE_RATES:
+            await self.conn.execute(build_sample_statement(rate, SAMPLE_MIN_STRATUM_ROWS))
+            self.sample_rates.append(rate)
+
+    async def warm(self: "SalesData") -> None:
+        """Load the schema snapshot, page cache, samples and common rollups before the database receives queries."""
+        await self.get_database_info()
+        await asyncio.to_thread(self.__read_database_file)
+        if APPROXIMATE_QUERIES:
+            await self.build_samples()
+        # The connection is shared by every session, so SQL from the model must not change the samples or shadow
+        # sales_data with a temporary table. PRAGMA query_only alone could be switched off again.
+        await self.conn.set_authorizer(authorize_read)
+        for rollup in WARM_ROLLUPS:
+            await self.query_sales_metrics(arguments=rollup)
+
     async def __get_table_names(self: "SalesData") -> list:
         """Return a list of table names."""
         table_names = []
@@ -72,6 +168,9 @@ class SalesData:
 
     async def get_database_info(self: "SalesData") -> str:
         """Return a string containing the database schema information and common query fields."""
+        if self.database_info is not None:
+            return self.database_info
+
         table_dicts = []
         for table_name in await self.__get_table_names():
             columns_names = await self.__get_column_info(table_name)
@@ -94,30 +193,188 @@ class SalesData:
         database_info += f"\nReporting Years: {', '.join(reporting_years)}"
         database_info += "\n\n"
 
+        self.database_info = database_info
         return database_info
 
-    async def ask_database(self: "SalesData", query: str) -> QueryResults:
-        """Function to query SQLite database with a provided SQL query."""
+    async def __fetch_rows(self: "SalesData", query: str, parameters: tuple) -> tuple:
+        """Execute a query and return its rows and column names."""
+        # Perform the query asynchronously
+        async with self.conn.execute(query, parameters) as cursor:
+            rows = await cursor.fetchall()
+            columns = [description[0] for description in cursor.description]
+        return rows, columns
+
+    async def __fetch(self: "SalesData", query: str, parameters: tuple = ()) -> pd.DataFrame | None:
+        """Execute a query and return the results as a DataFrame, or None if there are no rows."""
+        # Queries run one at a time, so the statement of a cancelled call is the one running on the connection
+        async with self.query_lock:
+            fetch = asyncio.ensure_future(self.__fetch_rows(query, parameters))
+            try:
+                rows, columns = await asyncio.shield(fetch)
+            except asyncio.CancelledError:
+                # Cancelling the call doesn't stop the statement in the connection's worker thread, which every
+                # session shares, so interrupt it until it stops, including if it hadn't started yet
+                while not fetch.done():
+                    await self.conn.interrupt()
+                    await asyncio.wait({fetch}, timeout=INTERRUPT_POLL_SECONDS)
+                # Retrieve the interrupted error so it isn't reported as never retrieved
+                if not fetch.cancelled():
+                    fetch.exception()
+                raise
+
+        # No need to create DataFrame if there are no rows
+        return pd.DataFrame(rows, columns=columns) if rows else None
+
+    def __format(self: "SalesData", data: pd.DataFrame | None, metadata: dict | None = None) -> QueryResults:
+        """Return the results in display and JSON formats."""
         data_results = QueryResults()
 
+        if data is None:
+            data_results.display_format = "The query returned no results. Try a different query."
+            data_results.json_format = ""
+        else:
+            data_results.display_format = data.to_string(index=False, max_rows=DISPLAY_MAX_ROWS)
+            data_results.json_format, handle = encode_results(data, metadata=metadata)
+            data_results.handle = handle or ""
+            if metadata:
+                data_results.display_format = f"{metadata['note']}\n\n{data_results.display_format}"
+
+        return data_results
+
+    @contextlib.contextmanager
+    def __in_flight(self: "SalesData") -> Iterator[None]:
+        """Track a query call so a retired snapshot is only closed once its calls have drained."""
+        self.in_flight += 1
+        self.idle.clear()
         try:
-            # Perform the query asynchronously
-            async with self.conn.execute(query) as cursor:
-                rows = await cursor.fetchall()
-                columns = [description[0] for description in cursor.description]
-
-            if not rows:  # No need to create DataFrame if there are no rows
-                data_results.display_format = "The query returned no results. Try a different query."
-                data_results.json_format = ""
-            else:
-                # Only create DataFrame if there are rows
-                data = pd.DataFrame(rows, columns=columns)
-                data_results.display_format = data.to_string(index=False)
-                data_results.json_format = data.to_json(index=False, orient="split")
+            yield
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.idle.set()
+
+    async def __execute(self: "SalesData", query: str, parameters: tuple = (), exact: bool = True) -> QueryResults:
+        """Execute a query, estimating aggregates from a sample unless exact results are required."""
+        # A sample query and its exact fallback are tracked as one call
+        with self.__in_flight():
+            if not exact and self.sample_rates:
+                data_results = await self.__execute_approximate(query, parameters)
+                if data_results is not None:
+                    return data_results
+
+            return self.__format(await self.__fetch(query, parameters))
+
+    async def __execute_approximate(self: "SalesData", query: str, parameters: tuple = ()) -> QueryResults | None:
+        """Estimate an aggregate query from the smallest sample within the error tolerance.
 
+        Return None to fall back to exact execution when the query can't be estimated from a sample,
+        or no sample is precise enough.
+        """
+        for rate in self.sample_rates:
+            if (rewritten := rewrite_for_sample(query, rate)) is None:
+                return None
+            sample_query, variances = rewritten
+
+            try:
+                data = await self.__fetch(sample_query, parameters)
+            except aiosqlite.Error:
+                return None
+            if data is None:
+                return None
+
+            # A NULL or unbounded estimate, or one outside the tolerance, needs a larger sample
+            data, bounds = error_bounds(data, variances)
+            if any(bound is None or bound > APPROXIMATE_MAX_ERROR for bound in bounds.values()):
+                continue
+
+            errors = ", ".join(f"{column} ±{bound:.1%}" for column, bound in bounds.items())
+            metadata = {
+                "approximate": True,
+                "sample_rate": rate,
+                "confidence": 0.95,
+                "relative_error": bounds,
+                "note": (
+                    f"Approximate results estimated from a {rate:.0%} stratified sample, "
+                    f"95% relative error at most {errors}. Ask for exact figures if precision matters."
+                ),
+            }
+            return self.__format(data, metadata)
+
+        return None
+
+    def __query_failed(self: "SalesData", error: Exception, query: str) -> QueryResults:
+        """Return the results reported to the model when a query fails."""
+        return QueryResults(
+            display_format=f"Query failed with error: {error}",
+            json_format=json.dumps({"error": str(error), "query": query}),
+        )
+
+    async def ask_database(self: "SalesData", query: str, exact: bool = False) -> QueryResults:
+        """Function to query SQLite database with a provided SQL query."""
+        try:
+            return await self.__execute(query, exact=exact or not APPROXIMATE_QUERIES)
+        except Exception as e:
+            return self.__query_failed(e, query)
+
+    async def query_sales_metrics(self: "SalesData", arguments: dict) -> QueryResults:
+        """Function to query aggregated sales metrics using a canonical parameterized statement."""
+        try:
+            query, parameters = build_metrics_statement(
+                metrics=arguments.get("metrics"),
+                group_by=arguments.get("group_by"),
+                filters=arguments.get("filters"),
+                order_by=arguments.get("order_by"),
+                order=arguments.get("order"),
+                limit=arguments.get("limit"),
+            )
+        except (TypeError, ValueError) as e:
+            return QueryResults(
+                display_format=f"Invalid metrics request: {e}",
+                json_format=json.dumps({"error": str(e), "arguments": arguments}),
+            )
+
+        exact = bool(arguments.get("exact")) or not APPROXIMATE_QUERIES
+
+        # The database is opened read-only, so results for identical parameter sets can be reused.
+        cache_key = (query, parameters, exact)
+        if cache_key in self.metrics_cache:
+            self.metrics_cache.move_to_end(cache_key)
+            return self.metrics_cache[cache_key]
+
+        try:
+            data_results = await self.__execute(query, parameters, exact=exact)
         except Exception as e:
-            error_message = f"Query failed with error: {e}"
-            data_results.display_format = error_message
-            data_results.json_format = json.dumps({"error": str(e), "query": query})
+            return self.__query_failed(e, query)
+
+        # Results over the tool output budget refer to a handle that the result store may evict, so aren't cached
+        if data_results.handle:
+            return data_results
+
+        self.metrics_cache[cache_key] = data_results
+        if len(self.metrics_cache) > METRICS_CACHE_SIZE:
+            self.metrics_cache.popitem(last=False)
 
         return data_results
+
+    async def export_query_result(self: "SalesData", handle: str, file_format: str = "csv") -> QueryResults:
+        """Function to export the full result of an earlier query that was too large to return as tool output."""
+        data = result_store.get(handle)
+        if data is None:
+            error = f"No query result found for handle '{handle}'. Run the query again."
+            return QueryResults(display_format=error, json_format=json.dumps({"error": error}))
+
+        if file_format == "json":
+            file_content = data.to_json(index=False, orient="records").encode()
+        else:
+            file_format = "csv"
+            file_content = data.to_csv(index=False).encode()
+
+        file_name = f"query-result-{handle}.{file_format}"
+        return QueryResults(
+            display_format=f"Exported {len(data)} rows to {file_name}.",
+            json_format=json.dumps(
+                {"file_name": file_name, "rows": len(data), "status": "The file is shown to the user."}
+            ),
+            file_name=file_name,
+            file_content=file_content,
+        )
@@ -0,0 +1,123 @@
+import math
+from functools import lru_cache
+
+METRICS = {
+    "revenue": "SUM(revenue)",
+    "shipping_cost": "SUM(shipping_cost)",
+    "discount": "SUM(discount)",
+    "number_of_orders": "SUM(number_of_orders)",
+    "average_revenue": "AVG(revenue)",
+    "sales_count": "COUNT(*)",
+}
+
+DIMENSIONS = ["year", "month", "month_date", "region", "main_category", "product_type"]
+
+
+def _integer(value: object) -> int:
+    """Return the value as an int, rejecting values with a fractional part rather than truncating them."""
+    number = float(value) if isinstance(value, str) else value
+    if (
+        isinstance(number, bool)
+        or not isinstance(number, int | float)
+        or not math.isfinite(number)
+        or number != int(number)
+    ):
+        raise ValueError(f"{value!r} is not an integer")
+    return int(number)
+
+
+FILTERS = {
+    "year": _integer,
+    "month": _integer,
+    "region": str,
+    "main_category": str,
+    "product_type": str,
+}
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+@lru_cache(maxsize=256)
+def compile_metrics_statement(
+    metrics: tuple, group_by: tuple, filter_shape: tuple, order_by: str, descending: bool
+) -> str:
+    """Return the canonical parameterized SQL statement for a metrics query shape.
+
+    Arguments are expected in canonical order so that equivalent requests share the same
+    statement text, and therefore the same entry in the SQLite prepared-statement cache.
+    """
+    select = [*group_by, *[f"{METRICS[metric]} AS {metric}" for metric in metrics]]
+    statement = f"SELECT {', '.join(select)} FROM sales_data"
+
+    if filter_shape:
+        conditions = [f"{column} IN ({', '.join('?' * count)})" for column, count in filter_shape]
+        statement += f" WHERE {' AND '.join(conditions)}"
+    if group_by:
+        statement += f" GROUP BY {', '.join(group_by)}"
+    if order_by:
+        statement += f" ORDER BY {order_by} {'DESC' if descending else 'ASC'}"
+
+    return statement + " LIMIT ?;"
+
+
+def _as_list(value: object) -> list:
+    return value if isinstance(value, list) else [value]
+
+
+def build_metrics_statement(
+    metrics: list,
+    group_by: list | None = None,
+    filters: dict | None = None,
+    order_by: str | None = None,
+    order: str | None = None,
+    limit: int | None = None,
+) -> tuple:
+    """Validate a structured metrics request and return a (statement, parameters) tuple."""
+    metrics = _as_list(metrics or [])
+    group_by = _as_list(group_by or [])
+    filters = filters or {}
+
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object mapping column names to lists of values.")
+    if not metrics:
+        raise ValueError(f"At least one metric is required. Valid metrics: {', '.join(METRICS)}")
+    if unknown := [metric for metric in metrics if metric not in METRICS]:
+        raise ValueError(f"Unknown metrics: {', '.join(unknown)}. Valid metrics: {', '.join(METRICS)}")
+    if unknown := [dimension for dimension in group_by if dimension not in DIMENSIONS]:
+        raise ValueError(f"Unknown dimensions: {', '.join(unknown)}. Valid dimensions: {', '.join(DIMENSIONS)}")
+    if unknown := [column for column in filters if column not in FILTERS]:
+        raise ValueError(f"Unknown filters: {', '.join(unknown)}. Valid filters: {', '.join(FILTERS)}")
+
+    metrics = tuple(metric for metric in METRICS if metric in metrics)
+    group_by = tuple(dimension for dimension in DIMENSIONS if dimension in group_by)
+
+    filter_shape = []
+    parameters = []
+    for column, cast in FILTERS.items():
+        values = [value for value in _as_list(filters.get(column, [])) if value is not None]
+        if not values:
+            continue
+        try:
+            values = sorted({cast(value).upper() if cast is str else cast(value) for value in values})
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid value for filter '{column}': {e}") from e
+        filter_shape.append((column, len(values)))
+        parameters.extend(values)
+
+    if order_by and order_by not in metrics and order_by not in group_by:
+        raise ValueError(f"order_by must be one of the requested metrics or group_by dimensions, got '{order_by}'.")
+    if not order_by and group_by:
+        order_by = group_by[0]
+    if order is not None and (not isinstance(order, str) or order.lower() not in ("asc", "desc")):
+        raise ValueError(f"order must be 'asc' or 'desc', got {order!r}.")
+    descending = (order or "asc").lower() == "desc"
+
+    try:
+        limit = min(max(_integer(limit or DEFAULT_LIMIT), 1), MAX_LIMIT)
+    except ValueError as e:
+        raise ValueError(f"Invalid limit: {e}") from e
+    parameters.append(limit)
+
+    statement = compile_metrics_statement(metrics, group_by, tuple(filter_shape), order_by or "", descending)
+    return statement, tuple(parameters)
@@ -0,0 +1,208 @@
+import math
+import re
+
+import pandas as pd
+
+STRATA = ["year", "region", "main_category"]
+Z_95 = 1.96
+VARIANCE_COLUMN = "sample_variance_"
+
+string_literal_pattern = re.compile(r"'(?:[^']|'')*'")
+aggregate_pattern = re.compile(r"\b(SUM|COUNT|AVG|TOTAL|MIN|MAX|GROUP_CONCAT)\s*\(", re.IGNORECASE)
+unsupported_pattern = re.compile(r"\b(JOIN|UNION|INTERSECT|EXCEPT|WITH|OVER|DISTINCT)\b", re.IGNORECASE)
+from_pattern = re.compile(r"\bFROM\s+sales_data\b(?!\s*[,.])", re.IGNORECASE)
+clause_pattern = re.compile(r"\s*(?:WHERE|GROUP|ORDER|LIMIT|HAVING|;|$)", re.IGNORECASE)
+alias_pattern = re.compile(r"^\s*(?:AS\s+)?\"?\w*\"?\s*$", re.IGNORECASE)
+named_pattern = re.compile(r"(?:\bAS\s+|\)\s*)\"?\w+\"?\s*$", re.IGNORECASE)
+ESTIMATED_AGGREGATES = ("SUM", "COUNT", "AVG")
+
+
+def sample_table_name(rate: float) -> str:
+    return f"samples.sales_data_{str(rate).replace('.', '_')}"
+
+
+def build_sample_statement(rate: float, min_stratum_rows: int) -> str:
+    """Return the statement creating a stratified sample of sales_data, weighted by its stratum sampling rate.
+
+    Each year, region and main category stratum is sampled at the rate, with at least min_stratum_rows rows
+    so small strata are still represented.
+    """
+    strata = ", ".join(STRATA)
+    return f"""
+        CREATE TABLE {sample_table_name(rate)} AS
+        SELECT sampled.*, strata.stratum_rows * 1.0 / strata.sample_rows AS sample_weight
+        FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY {strata} ORDER BY random()) AS stratum_row
+            FROM main.sales_data
+        ) AS sampled
+        JOIN (
+            SELECT {strata}, COUNT(*) AS stratum_rows,
+                MIN(COUNT(*), MAX({min_stratum_rows}, CAST(COUNT(*) * {rate} + 0.999999 AS INTEGER))) AS sample_rows
+            FROM main.sales_data
+            GROUP BY {strata}
+        ) AS strata USING ({strata})
+        WHERE sampled.stratum_row <= strata.sample_rows;
+    """
+
+
+def _mask_literals(query: str) -> str:
+    """Blank out string literals, keeping their positions, so keywords inside them are ignored."""
+    return string_literal_pattern.sub(lambda match: "'" + "_" * (len(match.group()) - 2) + "'", query)
+
+
+def _closing_paren(masked: str, start: int) -> int:
+    depth = 0
+    for index in range(start, len(masked)):
+        if masked[index] == "(":
+            depth += 1
+        elif masked[index] == ")":
+            depth -= 1
+            if not depth:
+                return index
+    raise ValueError("Unbalanced parentheses.")
+
+
+def _top_level_indexes(masked: str, start: int, end: int, pattern: re.Pattern) -> list:
+    """Return the positions of pattern matches between start and end that are not inside parentheses."""
+    indexes = []
+    depth = 0
+    for index in range(start, end):
+        if masked[index] == "(":
+            depth += 1
+        elif masked[index] == ")":
+            depth -= 1
+        elif not depth and pattern.match(masked, index):
+            indexes.append(index)
+    return indexes
+
+
+def rewrite_for_sample(query: str, rate: float) -> tuple | None:
+    """Rewrite an aggregate query on sales_data to estimate its result from the sample table.
+
+    SUM, COUNT and AVG are replaced by weighted estimates, and variance columns are appended for each
+    estimated select list column. Return the rewritten query and a mapping of estimated column index to
+    its aggregate and variance columns, or None if the query can't be answered from a sample with error
+    bounds, for example when a select list column is an expression over aggregates.
+    """
+    masked = _mask_literals(query)
+    if len(re.findall(r"\bSELECT\b", masked, re.IGNORECASE)) != 1 or unsupported_pattern.search(masked):
+        return None
+    from_matches = list(from_pattern.finditer(masked))
+    if len(from_matches) != 1 or len(re.findall(r"\bFROM\b", masked, re.IGNORECASE)) != 1:
+        return None
+    aggregates = []
+    for match in aggregate_pattern.finditer(masked):
+        try:
+            close = _closing_paren(masked, match.end() - 1)
+        except ValueError:
+            return None
+        aggregates.append((match.start(), match.end(), close, match.group(1).upper()))
+    if not aggregates or any(aggregate[3] not in ESTIMATED_AGGREGATES for aggregate in aggregates):
+        return None
+
+    # Every select list column with an aggregate must be a single aggregate, so it gets an error bound
+    select_start = re.search(r"\bSELECT\b", masked, re.IGNORECASE).end()
+    select_end = len(masked[: from_matches[0].start()].rstrip())
+    commas = _top_level_indexes(masked, select_start, select_end, re.compile(","))
+    boundaries = [select_start, *[index + 1 for index in commas]]
+    columns = list(zip(boundaries, [*[index - 1 for index in boundaries[1:]], select_end], strict=True))
+    estimated = []
+    aliases = []
+    for column_index, (column_start, column_end) in enumerate(columns):
+        inside = [aggregate for aggregate in aggregates if column_start <= aggregate[0] < column_end]
+        if not inside:
+            continue
+        start, _, close, _ = inside[0]
+        if len(inside) != 1 or masked[column_start:start].strip():
+            return None
+        if not alias_pattern.match(masked[close + 1 : column_end]):
+            return None
+        # Keep the column names of the exact query for estimated columns without an alias
+        if not named_pattern.search(masked[column_start:column_end]):
+            name = query[column_start:column_end].strip()
+            alias_end = column_start + len(query[column_start:column_end].rstrip())
+            aliases.append((alias_end, alias_end, ' AS "{}"'.format(name.replace('"', '""'))))
+        estimated.append((column_index, inside[0]))
+    if not estimated:
+        return None
+
+    def weighted(aggregate: tuple) -> str:
+        _, open_end, close, name = aggregate
+        argument = query[open_end:close].strip()
+        if name == "SUM":
+            return f"SUM(({argument}) * sample_weight)"
+        weight = "sample_weight" if argument == "*" else f"CASE WHEN ({argument}) IS NOT NULL THEN sample_weight END"
+        if name == "COUNT":
+            return f"SUM({weight})"
+        return f"(SUM(({argument}) * sample_weight) / SUM({weight}))"
+
+    def variance_terms(aggregate: tuple) -> list:
+        """Return the sums the variance of the estimate is computed from, see error_bounds."""
+        _, open_end, close, name = aggregate
+        argument = query[open_end:close].strip()
+        factor = "sample_weight * (sample_weight - 1)"
+        if name == "SUM":
+            return [f"SUM({factor} * ({argument}) * ({argument}))"]
+        not_null = "1" if argument == "*" else f"CASE WHEN ({argument}) IS NOT NULL THEN 1 END"
+        if name == "COUNT":
+            return [f"SUM({not_null} * {factor})"]
+        return [
+            f"SUM({factor} * ({argument}) * ({argument}))",
+            f"SUM({factor} * ({argument}))",
+            f"SUM({not_null} * {factor})",
+            f"SUM({not_null} * sample_weight)",
+        ]
+
+    variances = {}
+    variance_columns = []
+    for column_index, aggregate in estimated:
+        names = []
+        for term_index, term in enumerate(variance_terms(aggregate)):
+            names.append(f"{VARIANCE_COLUMN}{column_index}_{term_index}")
+            variance_columns.append(f", {term} AS {names[-1]}")
+        variances[column_index] = (aggregate[3], names)
+
+    # Apply the edits from the end of the query so earlier positions stay valid
+    table_end = from_matches[0].end()
+    table = sample_table_name(rate)
+    if clause_pattern.match(masked, table_end):
+        table += " AS sales_data"
+    # Variance columns are inserted before the alias of the last column, so they follow it in the query
+    edits = [(select_end, select_end, "".join(variance_columns))]
+    edits.extend(aliases)
+    edits.extend((aggregate[0], aggregate[2] + 1, weighted(aggregate)) for aggregate in aggregates)
+    edits.append((table_end - len("sales_data"), table_end, table))
+    rewritten = query
+    for start, end, text in sorted(edits, key=lambda edit: edit[0], reverse=True):
+        rewritten = rewritten[:start] + text + rewritten[end:]
+
+    return rewritten, variances
+
+
+def error_bounds(data: pd.DataFrame, variances: dict) -> tuple:
+    """Remove the variance columns from the estimates and return them with the 95% relative error per column.
+
+    The variance of a SUM or COUNT estimate is the sum of w(w - 1)y² over the sampled rows, with weight w.
+    AVG is a ratio estimate R = Σwy / Σw, with linearized variance Σw(w - 1)(y - R)² / (Σw)², expanded
+    into sums that SQL can compute per group. A column whose estimate is NULL or zero has no bound (None).
+    COUNT estimates are rounded to whole numbers.
+    """
+    bounds = {}
+    for column_index, (aggregate, variance_columns) in variances.items():
+        column = data.columns[column_index]
+        estimates = pd.to_numeric(data.iloc[:, column_index], errors="coerce")
+        terms = [data[variance_column].astype(float) for variance_column in variance_columns]
+        if aggregate == "AVG":
+            squares, values, weights, total = terms
+            variance = (squares - 2 * estimates * values + estimates**2 * weights) / total**2
+        else:
+            variance = terms[0]
+
+        relative = Z_95 * variance.clip(lower=0).pow(0.5) / estimates.abs()
+        relative = relative.replace([math.inf, -math.inf], math.nan)
+        bounds[column] = None if relative.isna().any() else round(float(relative.max()), 4)
+        if aggregate == "COUNT" and not estimates.isna().any():
+            data.isetitem(column_index, estimates.round().astype("int64"))
+
+    variance_columns = [column for _, columns in variances.values() for column in columns]
+    return data.drop(columns=variance_columns), bounds
@@ -0,0 +1,100 @@
+import asyncio
+import os
+from pathlib import Path
+
+from sales_data import DATA_BASE, SalesData
+
+SNAPSHOT_DIR = os.getenv("DATABASE_SNAPSHOT_DIR", "./database/snapshots")
+SNAPSHOT_POLL_SECONDS = int(os.getenv("DATABASE_SNAPSHOT_POLL_SECONDS", "60"))
+
+
+class SnapshotManager:
+    """Serve queries from the newest database snapshot and hot-swap to new snapshots as they appear.
+
+    A snapshot is either a non-hidden version directory under SNAPSHOT_DIR containing the database file, or,
+    when no version directories exist, the default database file versioned by its modification time, size and inode.
+    """
+
+    def __init__(self: "SnapshotManager") -> None:
+        self.sales_data: SalesData = None
+        self.lock = asyncio.Lock()
+        self.watch_task = None
+        self.retiring = set()
+
+    @property
+    def version(self: "SnapshotManager") -> str:
+        return self.sales_data.version if self.sales_data else None
+
+    def discover(self: "SnapshotManager") -> tuple:
+        """Return the (version, database path) of the newest available snapshot."""
+        database_name = Path(DATA_BASE).name
+        snapshot_dir = Path(SNAPSHOT_DIR)
+        if snapshot_dir.is_dir():
+            versions = sorted(
+                (
+                    path
+                    for path in snapshot_dir.iterdir()
+                    # Hidden directories are staging areas for snapshots still being copied
+                    if not path.name.startswith(".") and (path / database_name).is_file()
+                ),
+                key=lambda path: path.name,
+            )
+            if versions:
+                return versions[-1].name, str(versions[-1] / database_name)
+
+        # Nanosecond mtime, size and inode detect replacements made within the same second
+        stat = Path(DATA_BASE).stat()
+        return f"{stat.st_mtime_ns}-{stat.st_size}-{stat.st_ino}", DATA_BASE
+
+    async def start(self: "SnapshotManager") -> None:
+        """Activate the newest snapshot if none is active and start watching for new ones."""
+        if self.sales_data is None:
+            await self.refresh()
+        if SNAPSHOT_POLL_SECONDS > 0 and self.watch_task is None:
+            self.watch_task = asyncio.create_task(self.watch())
+
+    async def refresh(self: "SnapshotManager", force: bool = False) -> bool:
+        """Warm the newest snapshot and switch new queries to it. Return True if the active snapshot changed."""
+        async with self.lock:
+            version, database = self.discover()
+            if version == self.version and not force:
+                return False
+
+            sales_data = SalesData(database=database, version=version)
+            await sales_data.connect()
+            if sales_data.conn is None:
+                raise RuntimeError(f"Unable to open database snapshot {version}.")
+            try:
+                await sales_data.warm()
+            except Exception:
+                await sales_data.close()
+                raise
+
+            # Queries already running keep their reference to the old snapshot and drain before it is closed.
+            retired, self.sales_data = self.sales_data, sales_data
+            if retired:
+                task = asyncio.create_task(retired.drain_and_close())
+                self.retiring.add(task)
+                task.add_done_callback(self.retiring.discard)
+
+            print(f"Database snapshot {version} activated.")
+            return True
+
+    async def watch(self: "SnapshotManager") -> None:
+        """Poll for new snapshots."""
+        while True:
+            await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Database snapshot refresh failed: {e}")
+
+    def status(self: "SnapshotManager") -> dict:
+        """Return the active snapshot version and database path."""
+        return {
+            "version": self.version,
+            "database": self.sales_data.database if self.sales_data else None,
+        }
+
+
+snapshot_manager = SnapshotManager()
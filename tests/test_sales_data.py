@@ -0,0 +1,101 @@
+import asyncio
+import sqlite3
+import time
+from pathlib import Path
+
+import pytest
+
+import sales_data as sales_data_module
+from sales_data import SalesData
+
+HEAVY_QUERY = "SELECT COUNT(*) FROM sales_data AS a, sales_data AS b, sales_data AS c WHERE a.revenue < b.revenue"
+
+
+@pytest.fixture
+def database(tmp_path: Path) -> str:
+    path = tmp_path / "contoso-sales.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE sales_data (id INTEGER PRIMARY KEY, year INTEGER, month INTEGER, month_date TEXT, "
+            "region TEXT, main_category TEXT, product_type TEXT, revenue REAL, number_of_orders INTEGER)"
+        )
+        conn.executemany(
+            "INSERT INTO sales_data VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    2023 + row % 2,
+                    row % 12 + 1,
+                    f"{2023 + row % 2}-{row % 12 + 1:02d}-01",
+                    ["AFRICA", "EUROPE"][row % 2],
+                    ["CLOTHING", "FOOTWEAR"][row % 3 % 2],
+                    "JACKETS",
+                    row * 1.5,
+                    row % 5,
+                )
+                for row in range(2000)
+            ],
+        )
+    conn.close()
+    return str(path)
+
+
+async def connect(database: str) -> SalesData:
+    sales_data = SalesData(database=database)
+    await sales_data.connect()
+    return sales_data
+
+
+def test_cancelled_query_frees_the_connection(database: str) -> None:
+    async def cancel_heavy_query() -> float:
+        sales_data = await connect(database)
+        try:
+            task = asyncio.create_task(sales_data.ask_database(HEAVY_QUERY))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+            start = time.monotonic()
+            results = await asyncio.wait_for(sales_data.ask_database("SELECT 1 AS one"), timeout=10)
+            assert results.json_format == '{"columns":["one"],"data":[[1]]}'
+            assert sales_data.idle.is_set()
+            return time.monotonic() - start
+        finally:
+            await sales_data.close()
+
+    assert asyncio.run(cancel_heavy_query()) < 1
+
+
+def test_warmed_snapshot_rejects_writes(database: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(sales_data_module, "APPROXIMATE_QUERIES", True)
+    monkeypatch.setattr(sales_data_module, "APPROXIMATE_MIN_ROWS", 0)
+    monkeypatch.setattr(sales_data_module, "SAMPLE_RATES", [1.0])
+    total_weight = "SELECT SUM(sample_weight) AS total_weight FROM samples.sales_data_1_0"
+
+    async def write_to_samples() -> None:
+        sales_data = await connect(database)
+        try:
+            await sales_data.warm()
+            assert sales_data.sample_rates == [1.0]
+            before = await sales_data.ask_database(total_weight, exact=True)
+
+            for statement in [
+                "UPDATE samples.sales_data_1_0 SET sample_weight = sample_weight * 1000",
+                "DELETE FROM samples.sales_data_1_0",
+                "CREATE TEMP TABLE sales_data AS SELECT * FROM main.sales_data LIMIT 1",
+                "PRAGMA query_only = OFF",
+                "DETACH DATABASE samples",
+            ]:
+                results = await sales_data.ask_database(statement)
+                assert results.display_format.startswith("Query failed"), statement
+
+            assert (await sales_data.ask_database(total_weight, exact=True)).json_format == before.json_format
+            results = await sales_data.ask_database("PRAGMA table_info('sales_data')")
+            assert '"year","INTEGER"' in results.json_format
+            results = await sales_data.ask_database("SELECT COUNT(*) AS sales FROM sales_data")
+            # Estimates from the full sample are exact, with the sample weights unchanged
+            assert results.json_format.startswith('{"columns":["sales"],"data":[[2000]],"metadata":{"approximate":true')
+        finally:
+            await sales_data.close()
+
+    asyncio.run(write_to_samples())
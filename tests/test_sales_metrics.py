@@ -0,0 +1,57 @@
+import pytest
+
+from sales_metrics import DEFAULT_LIMIT, MAX_LIMIT, build_metrics_statement
+
+
+def test_equivalent_requests_share_a_canonical_statement() -> None:
+    statement, parameters = build_metrics_statement(
+        metrics=["number_of_orders", "revenue"],
+        group_by=["region", "year"],
+        filters={"region": ["europe", "Africa"], "year": ["2023", 2022.0]},
+    )
+    assert (
+        statement
+        == build_metrics_statement(
+            metrics=["revenue", "number_of_orders"],
+            group_by=["year", "region"],
+            filters={"year": [2022, 2023], "region": ["AFRICA", "EUROPE"]},
+        )[0]
+    )
+    assert statement == (
+        "SELECT year, region, SUM(revenue) AS revenue, SUM(number_of_orders) AS number_of_orders FROM sales_data "
+        "WHERE year IN (?, ?) AND region IN (?, ?) GROUP BY year, region ORDER BY year ASC LIMIT ?;"
+    )
+    assert parameters == (2022, 2023, "AFRICA", "EUROPE", DEFAULT_LIMIT)
+
+
+def test_scalar_arguments_are_accepted_as_lists() -> None:
+    statement, parameters = build_metrics_statement(
+        metrics="revenue", filters={"month": 3}, order_by="revenue", order="DESC", limit=5000
+    )
+    assert (
+        statement == "SELECT SUM(revenue) AS revenue FROM sales_data WHERE month IN (?) ORDER BY revenue DESC LIMIT ?;"
+    )
+    assert parameters == (3, MAX_LIMIT)
+
+
+@pytest.mark.parametrize(
+    ("arguments", "message"),
+    [
+        ({"metrics": []}, "At least one metric"),
+        ({"metrics": ["profit"]}, "Unknown metrics: profit"),
+        ({"metrics": ["revenue"], "group_by": ["customer"]}, "Unknown dimensions: customer"),
+        ({"metrics": ["revenue"], "filters": ["year"]}, "filters must be an object"),
+        ({"metrics": ["revenue"], "filters": {"customer": ["x"]}}, "Unknown filters: customer"),
+        ({"metrics": ["revenue"], "filters": {"year": [2023.7]}}, "Invalid value for filter 'year'"),
+        ({"metrics": ["revenue"], "filters": {"month": ["March"]}}, "Invalid value for filter 'month'"),
+        ({"metrics": ["revenue"], "order_by": "region"}, "order_by must be one of"),
+        ({"metrics": ["revenue"], "order": 1}, "order must be 'asc' or 'desc'"),
+        ({"metrics": ["revenue"], "order": "up"}, "order must be 'asc' or 'desc'"),
+        ({"metrics": ["revenue"], "limit": float("inf")}, "Invalid limit"),
+        ({"metrics": ["revenue"], "limit": "ten"}, "Invalid limit"),
+        ({"metrics": ["revenue"], "limit": 10.5}, "Invalid limit"),
+    ],
+)
+def test_invalid_requests_raise_value_error(arguments: dict, message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        build_metrics_statement(**arguments)
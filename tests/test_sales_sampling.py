@@ -0,0 +1,150 @@
+import math
+import sqlite3
+from collections.abc import Iterator
+
+import pandas as pd
+import pytest
+
+from sales_sampling import build_sample_statement, error_bounds, rewrite_for_sample
+
+SAMPLE_TABLE = "samples.sales_data_0_1"
+
+
+def rewrite(query: str) -> str:
+    rewritten = rewrite_for_sample(query, 0.1)
+    assert rewritten is not None
+    return rewritten[0]
+
+
+def test_rewrite_keeps_implicit_column_names() -> None:
+    query = "SELECT region, SUM(revenue) FROM sales_data GROUP BY region"
+    assert rewrite(query).startswith(
+        f'SELECT region, SUM((revenue) * sample_weight) AS "SUM(revenue)", '
+        "SUM(sample_weight * (sample_weight - 1) * (revenue) * (revenue)) AS sample_variance_1_0 "
+        f"FROM {SAMPLE_TABLE} AS sales_data GROUP BY region"
+    )
+
+
+def test_rewrite_keeps_explicit_aliases() -> None:
+    rewritten = rewrite("SELECT COUNT(*) AS orders, AVG(revenue) average FROM sales_data")
+    assert "SUM(sample_weight) AS orders" in rewritten
+    assert "(SUM((revenue) * sample_weight) / SUM(CASE WHEN (revenue) IS NOT NULL THEN sample_weight END)) average" in (
+        rewritten
+    )
+    assert '"' not in rewritten
+
+
+def test_rewrite_returns_variance_columns_per_estimated_column() -> None:
+    _, variances = rewrite_for_sample("SELECT year, COUNT(*), AVG(revenue) FROM sales_data GROUP BY year", 0.1)
+    assert variances == {
+        1: ("COUNT", ["sample_variance_1_0"]),
+        2: ("AVG", [f"sample_variance_2_{index}" for index in range(4)]),
+    }
+
+
+def test_rewrite_estimates_having_and_order_by_aggregates() -> None:
+    rewritten = rewrite(
+        "SELECT region, SUM(revenue) AS total FROM sales_data GROUP BY region "
+        "HAVING SUM(revenue) > 1000 ORDER BY COUNT(*) DESC"
+    )
+    assert "HAVING SUM((revenue) * sample_weight) > 1000" in rewritten
+    assert "ORDER BY SUM(sample_weight) DESC" in rewritten
+
+
+def test_rewrite_ignores_keywords_in_string_literals() -> None:
+    rewritten = rewrite("SELECT SUM(revenue) AS total FROM sales_data WHERE product_type = 'SUM(x) FROM JOIN'")
+    assert rewritten.endswith(f"FROM {SAMPLE_TABLE} AS sales_data WHERE product_type = 'SUM(x) FROM JOIN'")
+
+
+def test_rewrite_keeps_table_alias() -> None:
+    rewritten = rewrite("SELECT s.region, SUM(s.revenue) AS total FROM sales_data s GROUP BY s.region")
+    assert f"FROM {SAMPLE_TABLE} s GROUP BY s.region" in rewritten
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT region FROM sales_data GROUP BY region",
+        "SELECT SUM(revenue) FROM sales_data JOIN regions USING (region)",
+        "SELECT SUM(revenue) FROM sales_data, regions",
+        "SELECT SUM(revenue) FROM (SELECT revenue FROM sales_data)",
+        "SELECT SUM(revenue) FROM sales_data WHERE year IN (SELECT MAX(year) FROM sales_data)",
+        "SELECT COUNT(DISTINCT region) FROM sales_data",
+        "SELECT MAX(revenue) FROM sales_data",
+        "SELECT SUM(revenue), MIN(revenue) FROM sales_data",
+        "SELECT ROUND(SUM(revenue), 2) FROM sales_data",
+        "SELECT SUM(revenue) / SUM(number_of_orders) FROM sales_data",
+        "SELECT SUM(revenue) * 2 AS doubled FROM sales_data",
+    ],
+)
+def test_rewrite_rejects_queries_without_error_bounds(query: str) -> None:
+    assert rewrite_for_sample(query, 0.1) is None
+
+
+@pytest.fixture
+def conn() -> Iterator[sqlite3.Connection]:
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE sales_data (year INTEGER, region TEXT, main_category TEXT, revenue REAL)")
+    conn.executemany(
+        "INSERT INTO sales_data VALUES (?, ?, ?, ?)",
+        [
+            (2023 + index % 2, ["AFRICA", "EUROPE"][index % 3 % 2], "CLOTHING", None if index % 7 else index * 1.5)
+            for index in range(200)
+        ],
+    )
+    conn.execute("ATTACH DATABASE '' AS samples")
+    conn.executescript(build_sample_statement(1.0, 30))
+    yield conn
+    conn.close()
+
+
+def test_full_sample_estimates_equal_exact_results(conn: sqlite3.Connection) -> None:
+    query = (
+        "SELECT year, region, SUM(revenue) AS revenue, COUNT(*), COUNT(revenue) AS priced, AVG(revenue) "
+        "FROM sales_data GROUP BY year, region ORDER BY year, region"
+    )
+    exact = pd.read_sql_query(query, conn)
+    sample_query, variances = rewrite_for_sample(query, 1.0)
+    data, bounds = error_bounds(pd.read_sql_query(sample_query, conn), variances)
+
+    pd.testing.assert_frame_equal(data, exact, check_dtype=False)
+    assert bounds == {"revenue": 0, "COUNT(*)": 0, "priced": 0, "AVG(revenue)": 0}
+
+
+def test_error_bounds_uses_ratio_variance_for_avg() -> None:
+    # Two rows (y, w) = (10, 2) and (20, 4): R = 100 / 6 and the variance is Σw(w - 1)(y - R)² / (Σw)²
+    estimate = 100 / 6
+    data = pd.DataFrame(
+        {
+            "average": [estimate],
+            "sample_variance_0_0": [2 * 1 * 10**2 + 4 * 3 * 20**2],
+            "sample_variance_0_1": [2 * 1 * 10 + 4 * 3 * 20],
+            "sample_variance_0_2": [2 * 1 + 4 * 3],
+            "sample_variance_0_3": [2 + 4],
+        }
+    )
+    variances = {0: ("AVG", [f"sample_variance_0_{index}" for index in range(4)])}
+    data, bounds = error_bounds(data, variances)
+
+    variance = (2 * 1 * (10 - estimate) ** 2 + 4 * 3 * (20 - estimate) ** 2) / 6**2
+    assert list(data.columns) == ["average"]
+    assert bounds["average"] == round(1.96 * math.sqrt(variance) / estimate, 4)
+
+
+def test_error_bounds_has_no_bound_for_null_or_zero_estimates() -> None:
+    data = pd.DataFrame({"region": ["AFRICA", "EUROPE"], "total": [None, 5.0], "sample_variance_1_0": [None, 0.0]})
+    _, bounds = error_bounds(data, {1: ("SUM", ["sample_variance_1_0"])})
+    assert bounds == {"total": None}
+
+    data = pd.DataFrame({"total": [0.0], "sample_variance_0_0": [0.0]})
+    _, bounds = error_bounds(data, {0: ("SUM", ["sample_variance_0_0"])})
+    assert bounds == {"total": None}
+
+
+def test_error_bounds_rounds_count_estimates() -> None:
+    data = pd.DataFrame({"orders": [99.6, 10.2], "sample_variance_0_0": [4.0, 1.0]})
+    data, bounds = error_bounds(data, {0: ("COUNT", ["sample_variance_0_0"])})
+    assert data["orders"].tolist() == [100, 10]
+    assert data["orders"].dtype == "int64"
+    # The bound of a column is its largest relative error over the groups
+    assert bounds == {"orders": round(1.96 * 1 / 10.2, 4)}
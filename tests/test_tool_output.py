@@ -0,0 +1,78 @@
+import json
+
+import pandas as pd
+import pytest
+
+from tool_output import encode_results, result_store
+
+BUDGET = 4000
+
+
+def sales(rows: int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "region": [["AFRICA", "EUROPE", "ASIA-PACIFIC"][row % 3] for row in range(rows)],
+            "revenue": [row * 10.5 for row in range(rows)],
+        }
+    )
+
+
+def test_results_within_budget_are_sent_in_split_format() -> None:
+    data = sales(3)
+    output, handle = encode_results(data, budget=BUDGET, metadata={"approximate": True})
+
+    assert handle is None
+    assert json.loads(output) == {
+        "columns": ["region", "revenue"],
+        "data": [["AFRICA", 0.0], ["EUROPE", 10.5], ["ASIA-PACIFIC", 21.0]],
+        "metadata": {"approximate": True},
+    }
+
+
+def test_results_over_budget_are_stored_by_handle_with_a_sample() -> None:
+    data = sales(1000)
+    output, handle = encode_results(data, budget=BUDGET, metadata={"approximate": True})
+    decoded = json.loads(output)
+
+    assert len(output.encode()) <= BUDGET
+    assert result_store.get(handle) is data
+    assert decoded["handle"] == handle
+    assert decoded["row_count"] == 1000
+    assert decoded["metadata"] == {"approximate": True}
+    assert set(decoded["summary"]) == {"region", "revenue"}
+    assert decoded["summary"]["region"]["distinct"] == 3
+
+    # String columns are dictionary encoded
+    sample = decoded["sample"]
+    assert 0 < decoded["sample_rows"] < 1000
+    assert sample["dictionaries"]["region"] == ["AFRICA", "EUROPE", "ASIA-PACIFIC"]
+    assert sample["values"]["region"][:4] == [0, 1, 2, 0]
+    assert sample["values"]["revenue"] == data["revenue"].head(decoded["sample_rows"]).tolist()
+
+
+def test_wide_results_fit_the_budget() -> None:
+    data = pd.DataFrame({f"column_with_a_long_name_{index}": range(50) for index in range(300)})
+    output, handle = encode_results(data, budget=BUDGET)
+
+    assert len(output.encode()) <= BUDGET
+    assert json.loads(output)["handle"] == handle
+    assert result_store.get(handle) is data
+
+
+# pandas warns that split format omits repeated columns, although it encodes them all
+@pytest.mark.filterwarnings("ignore:DataFrame columns are not unique")
+def test_results_with_repeated_column_names_are_encoded() -> None:
+    data = pd.concat([sales(1000), sales(1000)["revenue"]], axis=1)
+    assert list(data.columns) == ["region", "revenue", "revenue"]
+
+    within_budget, handle = encode_results(data.head(2), budget=BUDGET)
+    assert handle is None
+    assert json.loads(within_budget)["columns"] == ["region", "revenue", "revenue"]
+
+    output, handle = encode_results(data, budget=BUDGET)
+    decoded = json.loads(output)
+    assert len(output.encode()) <= BUDGET
+    assert decoded["sample"]["columns"] == ["region", "revenue", "revenue_2"]
+    assert set(decoded["summary"]) == {"region", "revenue", "revenue_2"}
+    # The stored result keeps the column names of the query for export
+    assert list(result_store.get(handle).columns) == ["region", "revenue", "revenue"]
@@ -0,0 +1,147 @@
+import json
+import os
+import uuid
+from collections import OrderedDict
+
+import pandas as pd
+
+TOOL_OUTPUT_MAX_BYTES = int(os.getenv("TOOL_OUTPUT_MAX_BYTES", "32000"))
+TOOL_OUTPUT_MAX_TOKENS = int(os.getenv("TOOL_OUTPUT_MAX_TOKENS", "8000"))
+RESULT_STORE_SIZE = int(os.getenv("TOOL_OUTPUT_RESULT_STORE_SIZE", "32"))
+BYTES_PER_TOKEN = 4
+SAMPLE_ROWS = 100
+TOP_VALUES = 5
+
+
+class ResultStore:
+    """Keep the most recent full query results that were too large to send as tool output."""
+
+    def __init__(self: "ResultStore", size: int = RESULT_STORE_SIZE) -> None:
+        self.size = size
+        self.results: OrderedDict = OrderedDict()
+
+    def put(self: "ResultStore", data: pd.DataFrame) -> str:
+        handle = uuid.uuid4().hex[:12]
+        self.results[handle] = data
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+        return handle
+
+    def get(self: "ResultStore", handle: str) -> pd.DataFrame:
+        data = self.results.get(handle)
+        if data is not None:
+            self.results.move_to_end(handle)
+        return data
+
+
+result_store = ResultStore()
+
+
+def output_budget() -> int:
+    """Return the tool output budget in bytes."""
+    return min(TOOL_OUTPUT_MAX_BYTES, TOOL_OUTPUT_MAX_TOKENS * BYTES_PER_TOKEN)
+
+
+def _unique_columns(columns: list) -> list:
+    """Return the column names with repeats suffixed, so each name selects a single column."""
+    names = []
+    seen = set(columns)
+    counts: dict = {}
+    for column in columns:
+        counts[column] = counts.get(column, 0) + 1
+        name = column
+        if counts[column] > 1:
+            name = f"{column}_{counts[column]}"
+            while name in seen:
+                counts[column] += 1
+                name = f"{column}_{counts[column]}"
+            seen.add(name)
+        names.append(name)
+    return names
+
+
+def encode_columnar(data: pd.DataFrame) -> dict:
+    """Return the data in columnar form, with string columns dictionary encoded."""
+    values = {}
+    dictionaries = {}
+    for column in data.columns:
+        series = data[column]
+        if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            codes, uniques = pd.factorize(series)
+            values[column] = codes.tolist()
+            dictionaries[column] = json.loads(pd.Series(uniques).to_json(orient="values"))
+        else:
+            values[column] = json.loads(series.to_json(orient="values"))
+    return {"columns": list(data.columns), "values": values, "dictionaries": dictionaries}
+
+
+def summarize(data: pd.DataFrame, budget: int) -> dict:
+    """Return summary statistics for each column, for as many columns as fit in the byte budget."""
+    summary = {}
+    size = 2
+    for column in data.columns:
+        series = data[column]
+        if pd.api.types.is_numeric_dtype(series):
+            stats = series.agg(["min", "max", "mean", "sum"])
+            column_summary = json.loads(stats.to_json())
+        else:
+            top_values = series.value_counts().head(TOP_VALUES)
+            column_summary = {"distinct": int(series.nunique()), "top": json.loads(top_values.to_json())}
+
+        size += len(json.dumps({column: column_summary}, separators=(",", ":")).encode())
+        if size > budget:
+            break
+        summary[column] = column_summary
+    return summary
+
+
+def encode_results(data: pd.DataFrame, budget: int | None = None, metadata: dict | None = None) -> tuple:
+    """Encode query results as tool output within the byte budget. Return the output and the result handle.
+
+    Results within budget are sent in split JSON format, without a handle. Larger results are stored by
+    handle and sent as summary statistics plus a dictionary-encoded columnar sample that fits the budget.
+    Metadata about the results, such as approximation error bounds, is included in both forms.
+    """
+    budget = budget or output_budget()
+    split_format = data.to_json(index=False, orient="split")
+    if metadata:
+        split_format = json.dumps({**json.loads(split_format), "metadata": metadata}, separators=(",", ":"))
+    if len(split_format.encode()) <= budget:
+        return split_format, None
+
+    handle = result_store.put(data)
+    # Queries such as self-joins repeat column names, which the columnar sample and summary are keyed by
+    if data.columns.has_duplicates:
+        data = data.set_axis(_unique_columns(list(data.columns)), axis=1)
+    output = {
+        "format": "columnar",
+        "row_count": len(data),
+        "handle": handle,
+        "hint": (
+            f"The result has {len(data)} rows, which exceeds the tool output budget, so only a sample is included. "
+            "Aggregate the data in the query (GROUP BY with SUM, AVG or COUNT) or use query_sales_metrics. "
+            f"To give the user the full result, call export_query_result with handle '{handle}'."
+        ),
+        "summary": summarize(data, budget // 2),
+    }
+    if metadata:
+        output["metadata"] = metadata
+
+    sample_rows = min(len(data), SAMPLE_ROWS)
+    while True:
+        output["sample_rows"] = sample_rows
+        output["sample"] = encode_columnar(data.head(sample_rows))
+        encoded = json.dumps(output, separators=(",", ":"))
+        if len(encoded.encode()) <= budget:
+            return encoded, handle
+        if not sample_rows:
+            break
+        sample_rows //= 2
+
+    # Very wide results don't fit even without sample rows, so drop the sample and then the summary
+    for field in ("sample", "summary"):
+        output.pop(field)
+        encoded = json.dumps(output, separators=(",", ":"))
+        if len(encoded.encode()) <= budget:
+            break
+    return encoded, handle